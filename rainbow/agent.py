@@ -1,4 +1,6 @@
+import inspect
 import os
+from collections import defaultdict
 
 import gym
 import torch
@@ -12,7 +14,8 @@ from rainbow import models
 
 class Agent:
     """
-    :param env: gym environment
+    :param env: gym environment, or a list of gym environments stepped in lockstep so that their observations go
+                through the network in a single forward pass
     :param memory_size: maximum capacity of the memory replay
     :param batch_size
     :param learning_rate
@@ -28,6 +31,13 @@ class Agent:
     :param dist_params: dictionary containing parameters for distributional network including num_bins (number of bins
                         the distribution return), v_min (minimal state value), v_max (maximal state value)
                         e.i: {num_bin:51, v_min:0, v_max:1} 51 atoms are used in the paper
+    :param target_tau: when set, the target network of the double DQN follows the online one with soft updates of
+                       this rate after every replay, instead of being copied every 20 episodes (requires torch 2.x)
+    :param is_compiled: boolean to wrap the networks with torch.compile (requires torch 2.x)
+    :param compile_mode: torch.compile mode, "reduce-overhead" replays the forward passes with CUDA graphs, use
+                         "default" if the recompilations on varying batch sizes become an issue
+    :param device: torch device used by the networks, defaults to the first GPU when available. The networks are
+                   small enough that "cpu" can beat the kernel launch and transfer overhead of a GPU
     """
 
     def __init__(self,
@@ -48,90 +58,161 @@ class Agent:
                  is_distributional=False,
                  is_prioritized=False,
                  prioritized_params=None,
-                 distr_params=None):
-        self.env = env
+                 distr_params=None,
+                 target_tau=None,
+                 is_compiled=False,
+                 compile_mode="reduce-overhead",
+                 device=None):
+        self.envs = list(env) if isinstance(env, (list, tuple)) else [env]
+        self.env = self.envs[0]
+        self.num_envs = len(self.envs)
         self.num_episodes = num_episodes
         self.gamma = gamma
         self.batch_size = batch_size
         self.nsteps = nsteps
+        if device is None:
+            device = "cuda:" + str(0) if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.obs_size = self.env.observation_space.shape[0] * self.env.observation_space.shape[1]
         if is_prioritized:
             self.prioritized_params = prioritized_params
-            self.memory = PrioritizedExperienceReplay(memory_size, self.batch_size, prioritized_params, self.nsteps)
+            self.memory = PrioritizedExperienceReplay(memory_size, self.batch_size, self.obs_size, self.device,
+                                                      prioritized_params, self.nsteps, self.num_envs)
         else:
-            self.memory = ReplayMemory(memory_size, self.batch_size, self.gamma, self.nsteps)
+            self.memory = ReplayMemory(memory_size, self.batch_size, self.obs_size, self.device, self.gamma,
+                                       self.nsteps, self.num_envs)
         self.eps = eps
         self.min_eps = min_eps
         self.eps_decay = eps_decay
-        self.device = torch.device("cuda:" + str(0) if torch.cuda.is_available() else "cpu")
         model_dir = os.path.join(os.getcwd(), 'models')
         os.makedirs(model_dir, exist_ok=True)
         self.model_path = os.path.join(model_dir, model_filename + ".pt")
-        self.obs_size = env.observation_space.shape[0] * env.observation_space.shape[1]
 
         self.is_dueling = is_dueling
         self.is_noisy = is_noisy
         self.is_distributional = is_distributional
         self.is_prioritized = is_prioritized
         self.distr_params = distr_params
-        if self.is_distributional and self.is_dueling:
+        if self.is_distributional:
+            # Constant over training, computed once for every update
             self.distr_params["v_range"] = torch.linspace(self.distr_params["v_min"],
                                                           self.distr_params["v_max"],
-                                                          self.distr_params["num_bins"]).to(self.device)
-            self.model = models.DuelingDistributionalNetwork(self.obs_size, env.action_space.n, self.distr_params,
+                                                          self.distr_params["num_bins"], device=self.device)
+            self.distr_params["v_step"] = ((self.distr_params["v_max"] - self.distr_params["v_min"])
+                                           / (self.distr_params["num_bins"] - 1))
+            # Index of each sample of a minibatch, and its start in the flattened (batch_size, num_bins) projection
+            self.batch_range = torch.arange(self.batch_size, device=self.device)
+            self.distr_offset = (self.batch_range * self.distr_params["num_bins"]).unsqueeze(1)
+            # Reset in place at every update
+            self.distr_projection = torch.zeros(self.batch_size, self.distr_params["num_bins"], device=self.device)
+
+        if self.is_distributional and self.is_dueling:
+            self.model = models.DuelingDistributionalNetwork(self.obs_size, self.env.action_space.n, self.distr_params,
                                                              is_noisy).to(self.device)
 
         elif self.is_distributional:
-            self.distr_params["v_range"] = torch.linspace(self.distr_params["v_min"],
-                                                          self.distr_params["v_max"],
-                                                          self.distr_params["num_bins"]).to(self.device)
-            self.model = models.DistributionalNetwork(self.obs_size, env.action_space.n, self.distr_params,
+            self.model = models.DistributionalNetwork(self.obs_size, self.env.action_space.n, self.distr_params,
                                                       self.is_noisy).to(self.device)
         elif self.is_dueling:
-            self.model = models.DuelingNetwork(self.obs_size, env.action_space.n, is_noisy=is_noisy).to(self.device)
+            self.model = models.DuelingNetwork(self.obs_size, self.env.action_space.n,
+                                               is_noisy=is_noisy).to(self.device)
         else:
-            self.model = models.DQN(self.obs_size, env.action_space.n, is_noisy=is_noisy).to(self.device)
+            self.model = models.DQN(self.obs_size, self.env.action_space.n, is_noisy=is_noisy).to(self.device)
 
         self.is_double = is_double
+        self.target_tau = target_tau
         self.loss = []
         if self.is_double:
-            self.model_target = self.model.__class__(self.obs_size, env.action_space.n, self.distr_params,
+            self.model_target = self.model.__class__(self.obs_size, self.env.action_space.n, self.distr_params,
                                                      self.is_noisy).to(self.device)
             self.model_target.load_state_dict(self.model.state_dict())
             self.model_target.eval()
-        self.optimizer = optim.Adam(self.model.parameters(), lr=learning_rate)
-
-    def eps_greedy_action(self, state):
-        # Explore the environment
-        if self.eps > np.random.random():
-            # Take a random action
-            next_action = self.env.action_space.sample()
-        # Greedy choice (exploitation)
+        # One fused kernel for the whole parameter list on the GPU, multi-tensor updates otherwise, when the installed
+        # torch version supports them
+        adam_params = inspect.signature(optim.Adam).parameters
+        optimizer_kwargs = {}
+        if "fused" in adam_params and self.device.type == "cuda":
+            optimizer_kwargs["fused"] = True
+        elif "foreach" in adam_params:
+            optimizer_kwargs["foreach"] = True
+        self.optimizer = optim.Adam(self.model.parameters(), lr=learning_rate, **optimizer_kwargs)
+        self.zero_grad_kwargs = {}
+        if "set_to_none" in inspect.signature(self.optimizer.zero_grad).parameters:
+            self.zero_grad_kwargs["set_to_none"] = True
+
+        self.is_compiled = is_compiled
+        if self.is_compiled:
+            self.compile_models(compile_mode)
+
+    def compile_models(self, mode):
+        self.model = torch.compile(self.model, mode=mode, fullgraph=False)
+        if self.is_double:
+            self.model_target = torch.compile(self.model_target, mode=mode, fullgraph=False)
+
+        # Warm up every traced variant so that the first episodes are not spent recompiling: the online model is
+        # trained with grad enabled on replay batches, while acting, testing and the targets run under no_grad
+        def dummy_inputs(size):
+            dummy_states = torch.zeros(size, self.obs_size, device=self.device)
+            dummy_mask = torch.ones(size, self.env.action_space.n, dtype=torch.bool, device=self.device)
+            return dummy_states, dummy_mask
+
+        self.model(*dummy_inputs(self.batch_size))
+        with torch.no_grad():
+            for size in sorted({1, self.num_envs, self.batch_size}):
+                self.model(*dummy_inputs(size))
+            if self.is_double:
+                self.model_target(*dummy_inputs(self.batch_size))
+
+    @torch.no_grad()
+    def eps_greedy_action(self, states, possible_moves):
+        # Explore the environment, the exploration mask and the random picks are drawn in one call on the host, from the
+        # global torch generator so that torch.manual_seed makes the exploration reproducible
+        explore_draws, piece_picks, placement_picks = torch.rand(3, len(possible_moves)).numpy()
+        explore = explore_draws < self.eps
+        if explore.all():
+            # No need to wait on the device when every action is random
+            next_actions = [None] * len(possible_moves)
         else:
-            possible_moves = [self.env.ai_possible_indexes()]
-            legal_action = self.model(state.unsqueeze(0), possible_moves)
-            next_action = int(legal_action.argmax().detach().cpu())
+            # Greedy choice (exploitation), one forward pass and a single copy to the host for every environment
+            legal_mask = models.legal_moves_mask(possible_moves, self.env.action_space.n, self.device)
+            legal_action = self.model(states, legal_mask)
+            next_actions = legal_action.argmax(dim=1).tolist()
+
+        for env_idx in np.flatnonzero(explore):
+            # Take a random action like the environment sampler: a random piece among those with a legal placement,
+            # then one of its placements, out of the legal moves already listed for the mask
+            legal_moves = possible_moves[env_idx]
+            if legal_moves:
+                indexes_to_moves = self.envs[env_idx].all_possible_indexes_to_moves
+                moves_by_piece = defaultdict(list)
+                for move in legal_moves:
+                    moves_by_piece[indexes_to_moves[move].label].append(move)
+                piece_moves = list(moves_by_piece.values())[int(piece_picks[env_idx] * len(moves_by_piece))]
+                next_actions[env_idx] = piece_moves[int(placement_picks[env_idx] * len(piece_moves))]
+            else:
+                next_actions[env_idx] = self.envs[env_idx].action_space.sample()
 
-        return next_action
+        return next_actions
 
-    def update(self, reward, done, next_state, state, action, possible_move, indices=None, weights=None):
+    def update(self, reward, done, next_state, state, action, legal_mask, indices=None, weights=None):
         if self.is_distributional:
-            loss = self.get_distributional_loss(reward, done, next_state, state, action, possible_move)
+            loss = self.get_distributional_loss(reward, done, next_state, state, action, legal_mask)
         else:
-            target = self.get_target(reward, done, next_state, possible_move)
-            prediction = self.model(state, possible_move).gather(1, action)
+            target = self.get_target(reward, done, next_state, legal_mask)
+            prediction = self.model(state, legal_mask).gather(1, action)
             reduction = "none" if self.is_prioritized else "mean"
             loss = F.smooth_l1_loss(prediction, target, reduction=reduction)
 
         if self.is_prioritized:
             loss_no_reduction = loss.clone()
-            loss = torch.mean(loss * weights.to(self.device))
+            loss = torch.mean(loss * weights)
             priority = loss_no_reduction.detach().cpu().numpy() + self.prioritized_params["eps"]
             self.memory.update_priorities(indices, priority)
         else:
             loss = loss.mean()
 
-        self.loss.append(loss)
-        self.optimizer.zero_grad()
+        self.loss.append(float(loss.detach()))
+        self.optimizer.zero_grad(**self.zero_grad_kwargs)
         loss.backward()
         self.optimizer.step()
 
@@ -141,48 +222,47 @@ class Agent:
                 self.model_target.update_noise()
 
     # Inspired from https://github.com/Curt-Park/rainbow-is-all-you-need/blob/master/06.categorical_dqn.ipynb
-    def get_distributional_loss(self, reward, done, next_state, state, action, possible_move):
+    def get_distributional_loss(self, reward, done, next_state, state, action, legal_mask):
         action_distr = self.model.action_distr(state)
-        log_action_distr = action_distr[range(self.batch_size), action.reshape(-1)].log()
+        log_action_distr = action_distr[self.batch_range, action.reshape(-1)].log()
 
         with torch.no_grad():
             d_target = ((1 - done.float()) * self.gamma * self.distr_params["v_range"]
                         + reward.float()).clamp(self.distr_params["v_min"], self.distr_params["v_max"])
-            v_step = (self.distr_params["v_max"] - self.distr_params["v_min"]) / (self.distr_params["num_bins"] - 1)
-            delta = (d_target - self.distr_params["v_min"]) / v_step
+            delta = (d_target - self.distr_params["v_min"]) / self.distr_params["v_step"]
+            # delta is never negative, its fractional part is the weight of the upper bin
+            lower = delta.long()
+            upper = (lower + 1).clamp_(max=self.distr_params["num_bins"] - 1)
+            upper_weight = delta.frac()
 
-            offset = torch.linspace(0,
-                                    (self.batch_size - 1) * self.distr_params["num_bins"],
-                                    self.batch_size).to(self.device).repeat(self.distr_params["num_bins"], 1).T
-            legal_action = self.model(next_state, possible_move)
+            legal_action = self.model(next_state, legal_mask)
             next_action = legal_action.argmax(1)
             if self.is_double:
-                next_action_distr = self.model_target.action_distr(next_state)[range(self.batch_size), next_action]
+                next_action_distr = self.model_target.action_distr(next_state)[self.batch_range, next_action]
             else:
-                next_action_distr = self.model.action_distr(next_state)[range(self.batch_size), next_action]
-
-            # Projection
-            distr_projection = torch.zeros(next_action_distr.shape).to(self.device)
-            distr_projection.reshape(-1).index_add_(0,
-                                                    (delta.floor() + offset).long().reshape(-1),
-                                                    (next_action_distr * (delta.ceil() - delta)).reshape(-1))
-            distr_projection.reshape(-1).index_add_(0,
-                                                    (delta.ceil() + offset).long().reshape(-1),
-                                                    (next_action_distr * (delta - delta.floor())).reshape(-1))
+                next_action_distr = self.model.action_distr(next_state)[self.batch_range, next_action]
+
+            # Projection, both neighbouring bins in a single scatter
+            indices = (torch.stack((lower, upper)) + self.distr_offset).reshape(-1)
+            values = (torch.stack((1 - upper_weight, upper_weight)) * next_action_distr).reshape(-1)
+            distr_projection = self.distr_projection.zero_()
+            distr_projection.reshape(-1).index_add_(0, indices, values)
         if self.is_prioritized:
             return - (distr_projection * log_action_distr).sum(1)
 
         return - (distr_projection * log_action_distr).sum(1).mean()
 
-    def get_target_double(self, next_state, possible_move):
-        action = self.model(next_state, possible_move).argmax(dim=1, keepdim=True)
-        return self.model_target(next_state, possible_move).gather(1, action).detach()
+    @torch.no_grad()
+    def get_target_double(self, next_state, legal_mask):
+        action = self.model(next_state, legal_mask).argmax(dim=1, keepdim=True)
+        return self.model_target(next_state, legal_mask).gather(1, action)
 
-    def get_target(self, reward, done, next_state, possible_move):
+    @torch.no_grad()
+    def get_target(self, reward, done, next_state, legal_mask):
         if self.is_double:
-            next_state_max_q = self.get_target_double(next_state, possible_move)
+            next_state_max_q = self.get_target_double(next_state, legal_mask)
         else:
-            next_state_max_q = self.model(next_state, possible_move).max(dim=1, keepdim=True).values
+            next_state_max_q = self.model(next_state, legal_mask).max(dim=1, keepdim=True).values
 
         # y = r if done, y = r + gamma * max Q(s',a') if not done
         q = (1 - done.float()) * next_state_max_q * self.gamma
@@ -195,78 +275,116 @@ class Agent:
         else:
             idx, weight = None, None
             state, action, next_state, reward, done, possible_move = self.memory.get_random_batch()
-        self.update(reward, done, next_state, state, action, possible_move, idx, weight)
+        legal_mask = models.legal_moves_mask(possible_move, self.env.action_space.n, self.device)
+        self.update(reward, done, next_state, state, action, legal_mask, idx, weight)
+
+    def stack_boards(self, boards):
+        # Cells only hold player ids, the memory stores them as bytes
+        return np.array([board.numpy() for board in boards], dtype=np.uint8).reshape(len(boards), -1)
+
+    def process_states(self, states):
+        # Copy the stacked boards in one transfer and cast on the device
+        return torch.from_numpy(states).to(self.device).float()
 
     def process_state(self, state):
-        return state.view(-1).type(torch.float32).to(self.device)
+        return self.process_states(self.stack_boards([state]))[0]
+
+    @torch.no_grad()
+    def soft_update_target(self):
+        # One fused update over the whole parameter list
+        torch._foreach_lerp_(list(self.model_target.parameters()),  # pylint: disable=protected-access
+                             list(self.model.parameters()), self.target_tau)
+
+    def uncompiled_model(self):
+        # torch.compile wraps the module, its weights belong to the original one
+        return self.model._orig_mod if self.is_compiled else self.model  # pylint: disable=protected-access
+
+    def save_model(self):
+        torch.save(self.uncompiled_model().state_dict(), self.model_path)
 
     def train(self):
         rewards_lst = []
         best_rate = 0
         ten_eps_rew = []
         rew = []
-        for i in range(1, self.num_episodes):
-            rewards = 0
-            done = False
-            state = self.process_state(self.env.reset())
-            while not done:
-                action = self.eps_greedy_action(state)
-                possible_move = self.env.ai_possible_indexes()
-                next_state, reward, done, _ = self.env.step(action)
-
-                # env.render("human")
-                rewards += reward
-                next_state = self.process_state(next_state)
+        i = 1
+        rewards = [0] * self.num_envs
+        boards = self.stack_boards([env.reset() for env in self.envs])
+        while i < self.num_episodes:
+            possible_moves = [env.ai_possible_indexes() for env in self.envs]
+            actions = self.eps_greedy_action(self.process_states(boards), possible_moves)
+            steps = [env.step(action) for env, action in zip(self.envs, actions)]
+            next_boards = self.stack_boards([step[0] for step in steps])
+
+            # Only the action selection is batched, every stored transition is still followed by one replay like with
+            # a single environment
+            for env_idx, (_, reward, done, _) in enumerate(steps):
+                # self.envs[env_idx].render("human")
+                rewards[env_idx] += reward
 
                 if self.is_prioritized:
                     self.prioritized_params["b"] = min(1.0, i / self.num_episodes) * \
                         (1 - self.prioritized_params["b"]) + self.prioritized_params["b"]
                     self.memory.update_beta(self.prioritized_params["b"])
 
+                transition = (boards[env_idx], actions[env_idx], next_boards[env_idx], reward, done,
+                              possible_moves[env_idx])
                 if self.nsteps is not None:
-                    self.memory.add_nsteps_memory(state, action, next_state, reward, done, possible_move)
+                    self.memory.add_nsteps_memory(*transition, env_idx=env_idx)
                 else:
-                    self.memory.add_to_memory(state, action, next_state, reward, done, possible_move)
-                state = next_state
-
-                if not i % 20 and self.is_double:
-                    self.model_target.load_state_dict(self.model.state_dict())
+                    self.memory.add_to_memory(*transition, env_idx=env_idx)
 
                 if len(self.memory) > self.batch_size:
                     self.replay()
                     self.eps = max(self.min_eps, self.eps * self.eps_decay)
+                    if self.is_double and self.target_tau is not None:
+                        self.soft_update_target()
+
+            # Rows of next_boards are referenced by the n-steps buffers, finished games are reset on a copy
+            boards = next_boards.copy() if any(step[2] for step in steps) else next_boards
+            for env_idx, (_, reward, done, _) in enumerate(steps):
+                if not done:
+                    continue
+                if i == self.num_episodes:
+                    # Games ending on the last step beyond the requested number of episodes are not counted
+                    break
+                boards[env_idx] = self.stack_boards([self.envs[env_idx].reset()])[0]
+                rewards_lst.append(rewards[env_idx])
+                rewards[env_idx] = 0
+                if reward == 1:
+                    ten_eps_rew.append(1)
+                else:
+                    ten_eps_rew.append(0)
 
-            rewards_lst.append(rewards)
-            if reward == 1:
-                ten_eps_rew.append(1)
-            else:
-                ten_eps_rew.append(0)
+                if not i % 10 and i != 1:
+                    rew.append(sum(rewards_lst) / i)
+                    if rew[-1] > best_rate:
+                        best_rate = (sum(rewards_lst) / i)
+                        self.save_model()
 
-            if not i % 10 and i != 1:
-                rew.append(sum(rewards_lst) / i)
-                if rew[-1] > best_rate:
-                    best_rate = (sum(rewards_lst) / i)
-                    torch.save(self.model, self.model_path)
+                    print('Episode {} Win prop: {} Reward Rate {}'.format(i, sum(ten_eps_rew) / 10, rew[-1]))
+                    ten_eps_rew = []
 
-                print('Episode {} Win prop: {} Reward Rate {}'.format(i, sum(ten_eps_rew) / 10, rew[-1]))
-                ten_eps_rew = []
+                if not i % 20 and self.is_double and self.target_tau is None:
+                    self.model_target.load_state_dict(self.model.state_dict())
+                i += 1
 
-        torch.save(self.model, self.model_path)
-        self.env.close()
+        self.save_model()
+        for env in self.envs:
+            env.close()
         return rew
 
     def test(self):
-        self.model = torch.load(self.model_path, map_location=self.device)
-        state = self.process_state(self.env.reset())
+        self.uncompiled_model().load_state_dict(torch.load(self.model_path, map_location=self.device))
         self.eps = 0.0
         num_win = 0
         num_ties = 0
         for _ in range(self.num_episodes):
             done = False
             rewards = 0
-            self.env.reset()
+            state = self.process_state(self.env.reset())
             while not done:
-                action = self.eps_greedy_action(state)
+                action = self.eps_greedy_action(state.unsqueeze(0), [self.env.ai_possible_indexes()])[0]
                 next_state, reward, done, _ = self.env.step(action)
                 # self.env.render("human")
                 rewards += reward
@@ -281,7 +399,7 @@ class Agent:
 
 
 if __name__ == "__main__":
-    env = gym.make("blokus_gym:blokus-simple-greedy-v0")
+    env = [gym.make("blokus_gym:blokus-simple-greedy-v0") for _ in range(4)]
     memory_size = 1000
     num_episodes = 5000
     batch_size = 32
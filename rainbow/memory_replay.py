@@ -1,89 +1,135 @@
 import random
 from collections import deque
 
+import numpy as np
 import torch
 from rainbow.segment_tree import MinSegmentTree, SumSegmentTree
 
 
 class ReplayMemory:
-    def __init__(self, max_size, batch_size, gamma=0.9, nsteps=None):
-        self.max_size = max_size
+    def __init__(self, max_size, batch_size, obs_size, device, gamma=0.9, nsteps=None, num_envs=1):
+        assert max_size >= num_envs, "Every environment needs room for at least one transition"
         self.batch_size = batch_size
-        self.memory = deque([], maxlen=max_size)
+        self.device = device
+        self.obs_size = obs_size
+        # Every environment writes its transitions in its own ring, the transitions of a ring follow each other
+        # so the next state of a transition is the state of the transition stored nsteps slots later. Each board
+        # is then stored once, the ring has nsteps extra slots to hold the next states of the newest transitions.
+        # The rings share max_size evenly, the remainder of the division is left unused so as not to exceed it
+        self.link = nsteps or 1
+        self.ring_capacity = max_size // num_envs
+        self.ring_size = self.ring_capacity + self.link
+        self.num_slots = num_envs * self.ring_size
+        self.ring_counts = np.zeros(num_envs, dtype=np.int64)
+        # One preallocated array per field
+        # Board cells only hold player ids, they fit in 4 bits so two cells are packed in each byte
+        packed_size = (obs_size + 1) // 2
+        self.states = np.zeros((self.num_slots, packed_size), dtype=np.uint8)
+        self.actions = np.zeros(self.num_slots, dtype=np.int64)
+        self.rewards = np.zeros(self.num_slots, dtype=np.float32)
+        self.dones = np.zeros(self.num_slots, dtype=np.bool_)
+        # Legal moves do not have a fixed length
+        self.possible_moves = [None] * self.num_slots
         self.nsteps = nsteps
-        self.nsteps_buffer = deque([], maxlen=nsteps)
+        # One buffer per environment so that n-steps returns never mix transitions of different games
+        self.nsteps_buffers = [deque([], maxlen=nsteps) for _ in range(num_envs)]
         self.gamma = gamma
 
     def __len__(self):
-        return len(self.memory)
-
-    def add_to_memory(self, state, action, next_state, reward, done, possible_move):
-        self.memory.append((state, action, next_state, reward, done, possible_move))
-
-    def add_nsteps_memory(self, state, action, next_state, reward, done, possible_move):
-        self.nsteps_buffer.append((state, action, next_state, reward, done, possible_move))
-        if len(self.nsteps_buffer) < self.nsteps:
+        return int(self.ring_lengths().sum())
+
+    def ring_lengths(self):
+        return np.minimum(self.ring_counts, self.ring_capacity)
+
+    def next_index(self, indices):
+        rings, slots = np.divmod(indices, self.ring_size)
+        return rings * self.ring_size + (slots + self.link) % self.ring_size
+
+    def pack_state(self, packed, state):
+        np.left_shift(state[0::2], 4, out=packed)
+        packed[:self.obs_size // 2] |= state[1::2]
+
+    def unpack_states(self, packed):
+        # Unpacked on the device so that only half of the bytes are copied
+        packed = torch.from_numpy(packed).to(self.device)
+        cells = torch.stack((packed >> 4, packed & 0xF), dim=2).reshape(len(packed), -1)
+        return cells[:, :self.obs_size].float()
+
+    def add_to_memory(self, state, action, next_state, reward, done, possible_move, env_idx=0):
+        idx = env_idx * self.ring_size + self.ring_counts[env_idx] % self.ring_size
+        self.ring_counts[env_idx] += 1
+        self.pack_state(self.states[idx], state)
+        # This slot belonged to the transition leaving the ring, the transition stored there nsteps later starts from
+        # the same board. When done is set, that slot may hold the start of the next game instead, but the next state
+        # of a done transition is never used in the targets
+        self.pack_state(self.states[self.next_index(idx)], next_state)
+        self.actions[idx] = action
+        self.rewards[idx] = reward
+        self.dones[idx] = done
+        self.possible_moves[idx] = possible_move
+        return idx
+
+    def add_nsteps_memory(self, state, action, next_state, reward, done, possible_move, env_idx=0):
+        nsteps_buffer = self.nsteps_buffers[env_idx]
+        nsteps_buffer.append((state, action, next_state, reward, done, possible_move))
+        if len(nsteps_buffer) < self.nsteps:
             return
 
-        next_state, nsteps_reward, done = self.nsteps_buffer[-1][2:5]
+        next_state, nsteps_reward, done = nsteps_buffer[-1][2:5]
         for i in range(self.nsteps - 2, -1, -1):
-            ns, r, d = self.nsteps_buffer[i][2:5]
+            ns, r, d = nsteps_buffer[i][2:5]
             nsteps_reward = nsteps_reward * (self.gamma ** i) * (1 - d) + r
             if d:
                 next_state = ns
                 done = d
-        state, action = self.nsteps_buffer[0][:2]
-        possible_move = self.nsteps_buffer[0][-1]
-        self.add_to_memory(state, action, next_state, nsteps_reward, done, possible_move)
+        state, action = nsteps_buffer[0][:2]
+        possible_move = nsteps_buffer[0][-1]
+        self.add_to_memory(state, action, next_state, nsteps_reward, done, possible_move, env_idx)
 
     def get_random_batch(self):
-        random_batch = random.sample(self.memory, self.batch_size)
-        return self.create_batch(random_batch)
-
-    def create_batch(self, random_batch):
-        states = []
-        actions = []
-        next_states = []
-        rewards = []
-        dones = []
-        possible_moves = []
-        for b in random_batch:
-            state, action, next_state, reward, done, move = b
-            states.append(state)
-            actions.append(action)
-            next_states.append(next_state)
-            rewards.append(reward)
-            dones.append(done)
-            possible_moves.append(move)
-        states = torch.cat(states).reshape(self.batch_size, -1)
-        actions = torch.tensor(actions).unsqueeze(1).to(states.device)  # pylint: disable=not-callable
-        next_states = torch.cat(next_states).reshape(self.batch_size, -1)
-        rewards = torch.tensor(rewards).unsqueeze(1).to(states.device)  # pylint: disable=not-callable
-        dones = torch.tensor(dones).unsqueeze(1).to(states.device)  # pylint: disable=not-callable
+        # Map positions among the stored transitions to their slot, ring by ring
+        lengths = self.ring_lengths()
+        ends = np.cumsum(lengths)
+        positions = np.array(random.sample(range(len(self)), self.batch_size))
+        rings = np.searchsorted(ends, positions, side="right")
+        slots = (self.ring_counts[rings] - lengths[rings] + positions - (ends - lengths)[rings]) % self.ring_size
+        return self.create_batch(rings * self.ring_size + slots)
+
+    def create_batch(self, indices):
+        indices = np.asarray(indices)
+        states = self.unpack_states(self.states[indices])
+        actions = torch.from_numpy(self.actions[indices]).to(self.device).unsqueeze(1)
+        next_states = self.unpack_states(self.states[self.next_index(indices)])
+        rewards = torch.from_numpy(self.rewards[indices]).to(self.device).unsqueeze(1)
+        dones = torch.from_numpy(self.dones[indices]).to(self.device).unsqueeze(1)
+        possible_moves = [self.possible_moves[i] for i in indices]
         return states, actions, next_states, rewards, dones, possible_moves
 
 
 # Inspired from https://github.com/Curt-Park/rainbow-is-all-you-need/blob/master/03.per.ipynb
 class PrioritizedExperienceReplay(ReplayMemory):
-    def __init__(self, max_size, batch_size, prioritized_params, nsteps=None):
-        super(PrioritizedExperienceReplay, self).__init__(max_size, batch_size, nsteps=nsteps)
-        self.max_size = max_size
+    def __init__(self, max_size, batch_size, obs_size, device, prioritized_params, nsteps=None, num_envs=1):
+        super(PrioritizedExperienceReplay, self).__init__(max_size, batch_size, obs_size, device, nsteps=nsteps,
+                                                          num_envs=num_envs)
         self.tree_capacity = 1
-        while self.tree_capacity < self.max_size:
+        while self.tree_capacity < self.num_slots:
             # Data structure requires capacity to be a power of 2
             self.tree_capacity *= 2
         self.sum_tree = SumSegmentTree(self.tree_capacity)
         self.min_tree = MinSegmentTree(self.tree_capacity)
         self.a = prioritized_params["a"]
         self.b = prioritized_params["b"]
-        self.tree_idx = 0
         self.max_priority = 1.0
 
-    def add_to_memory(self, state, action, next_state, reward, done, possible_move):
-        super().add_to_memory(state, action, next_state, reward, done, possible_move)
-        self.sum_tree[self.tree_idx] = self.max_priority ** self.a
-        self.min_tree[self.tree_idx] = self.max_priority ** self.a
-        self.tree_idx = (self.tree_idx + 1) % self.max_size
+    def add_to_memory(self, state, action, next_state, reward, done, possible_move, env_idx=0):
+        idx = super().add_to_memory(state, action, next_state, reward, done, possible_move, env_idx)
+        self.sum_tree[idx] = self.max_priority ** self.a
+        self.min_tree[idx] = self.max_priority ** self.a
+        # The transition leaving the ring must not be sampled anymore
+        evicted_idx = self.next_index(idx)
+        self.sum_tree[evicted_idx] = 0.0
+        self.min_tree[evicted_idx] = float('inf')
+        return idx
 
     def update_priorities(self, indices, priorities):
         eps = 1e-5
@@ -93,7 +139,7 @@ class PrioritizedExperienceReplay(ReplayMemory):
             self.max_priority = max(self.max_priority, priority + eps)
 
     def sample_uniform(self):
-        segment = self.sum_tree.sum(0, len(self) - 1) / self.batch_size
+        segment = self.sum_tree.sum() / self.batch_size
         indices = []
         for i in range(self.batch_size):
             a = segment * i
@@ -111,11 +157,9 @@ class PrioritizedExperienceReplay(ReplayMemory):
         weights = []
         p_min = self.min_tree.min() / self.sum_tree.sum()
         max_weight = (p_min * len(self)) ** (-self.b)
-        batch = []
         for i in indices:
             p = self.sum_tree[i] / self.sum_tree.sum()
             weights.append((p * len(self)) ** (-self.b) / max_weight)
-            batch.append(self.memory[i])
-        states, actions, next_states, rewards, dones, possible_moves = self.create_batch(batch)
+        states, actions, next_states, rewards, dones, possible_moves = self.create_batch(indices)
         return states, actions, next_states, rewards, dones, possible_moves, indices, torch.tensor(
-            weights)  # pylint: disable-all
+            weights, device=self.device)  # pylint: disable-all
@@ -6,20 +6,25 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def legal_moves_mask(possible_moves, num_actions, device):
+    """
+    Boolean (batch, num_actions) mask of the legal moves, built outside of the networks so that they only take tensors
+    """
+    # Flatten the (batch, move) pairs so that the whole mask is written at once
+    batch_idx = [i for i, legal_moves in enumerate(possible_moves) for _ in legal_moves]
+    action_idx = [move for legal_moves in possible_moves for move in legal_moves]
+    legal_mask = torch.zeros(len(possible_moves), num_actions, dtype=torch.bool, device=device)
+    legal_mask[batch_idx, action_idx] = True
+    return legal_mask
+
+
 class FilterLegalMoves(nn.Module):
     """
     Custom layer to consider only valid moves
     """
 
-    def forward(self, x, possible_moves):
-        legal_moves = possible_moves
-        actions_tensor = torch.zeros(x.shape).to(x.device)
-        batch_size = x.shape[0]
-        for i in range(batch_size):
-            actions_tensor[i, legal_moves[i]] = 1.0
-        filtered_actions = x * actions_tensor
-        filtered_actions[filtered_actions == 0] = -np.inf
-        return filtered_actions
+    def forward(self, x, legal_mask):
+        return x.masked_fill(~legal_mask, -np.inf)
 
 
 class DQN(nn.Module):
@@ -41,12 +46,12 @@ class DQN(nn.Module):
         self.hidden_noisy_layer.update_noise()
         self.output_noisy_layer.update_noise()
 
-    def forward(self, x, possible_moves):
+    def forward(self, x, legal_mask):
         x = self.input_layer(x)
         x = self.hidden_noisy_layer(x)
         x = self.activation(x)
         x = self.output_noisy_layer(x)
-        return self.custom_softmax(x, possible_moves)
+        return self.custom_softmax(x, legal_mask)
 
 
 # Inspired from https://github.com/Curt-Park/rainbow-is-all-you-need/blob/master/05.noisy_net.ipynb
@@ -76,16 +81,18 @@ class NoisyLayer(nn.Module):
         nn.init.constant_(self.sigma_b, self.sigma_init / math.sqrt(self.out_dim))
 
     def update_noise(self):
-        self.eps_w.copy_(self.factorize_noise(self.out_dim).ger(self.factorize_noise(self.in_dim)))
+        # Written in place in the buffers, on their device
+        torch.mul(self.factorize_noise(self.out_dim).unsqueeze(1), self.factorize_noise(self.in_dim), out=self.eps_w)
         self.eps_b.copy_(self.factorize_noise(self.out_dim))
 
     def factorize_noise(self, size):
         # Modify scale to amplify or reduce noise
-        x = torch.Tensor(np.random.normal(loc=0.0, scale=0.001, size=size))
-        return x.sign().mul(x.abs().sqrt())
+        x = torch.randn(size, device=self.eps_w.device).mul_(0.001)
+        return x.sign().mul_(x.abs().sqrt_())
 
     def forward(self, x):
-        return F.linear(x, self.mu_w + self.sigma_w * self.eps_w, self.mu_b + self.sigma_b * self.eps_b)
+        return F.linear(x, torch.addcmul(self.mu_w, self.sigma_w, self.eps_w),
+                        torch.addcmul(self.mu_b, self.sigma_b, self.eps_b))
 
 
 class DuelingNetwork(nn.Module):
@@ -120,7 +127,7 @@ class DuelingNetwork(nn.Module):
         self.value_layer_hidden.update_noise()
         self.value_layer_out.update_noise()
 
-    def forward(self, x, possible_moves):
+    def forward(self, x, legal_mask):
         x = self.input_layer(x)
 
         # Advantage
@@ -133,7 +140,7 @@ class DuelingNetwork(nn.Module):
         value = self.value_layer_act(value)
         value = self.value_layer_out(value)
 
-        return self.custom_softmax(advantage + value - advantage.mean(), possible_moves)
+        return self.custom_softmax(advantage + value - advantage.mean(), legal_mask)
 
 
 class DistributionalNetwork(nn.Module):
@@ -168,9 +175,9 @@ class DistributionalNetwork(nn.Module):
         self.hidden_layer.update_noise()
         self.output.update_noise()
 
-    def forward(self, x, possible_moves):
+    def forward(self, x, legal_mask):
         x = torch.sum(self.action_distr(x) * self.v_range, dim=2)
-        return self.custom_softmax(x, possible_moves)
+        return self.custom_softmax(x, legal_mask)
 
 
 class DuelingDistributionalNetwork(nn.Module):
@@ -225,6 +232,6 @@ class DuelingDistributionalNetwork(nn.Module):
         q = value + advantage - advantage.mean(dim=1, keepdim=True)
         return self.softmax(q).clamp(1e-5)
 
-    def forward(self, x, possible_moves):
+    def forward(self, x, legal_mask):
         x = torch.sum(self.action_distr(x) * self.v_range, dim=2)
-        return self.custom_layer(x, possible_moves)
+        return self.custom_layer(x, legal_mask)